@@ -3,7 +3,7 @@ import os
 import requests
 import logging
 import threading
-from thingsboard_auth import get_admin_jwt
+from thingsboard_auth import get_admin_jwt, invalidate_admin_jwt
 from config import TB_ACCOUNTS
 from datetime import datetime, timedelta
 
@@ -25,7 +25,13 @@ def scheduler():
                     continue
 
                 headers = {"X-Authorization": f"Bearer {jwt_token}"}
-                all_assets = get_all_assets(base_url, headers)
+                try:
+                    all_assets = get_all_assets(base_url, headers)
+                except requests.HTTPError as e:
+                    # Token revoked before its 'exp': log in again on the next pass
+                    if e.response is not None and e.response.status_code == 401:
+                        invalidate_admin_jwt(account_id, base_url)
+                    raise
 
                 for asset in all_assets:
                     asset_id = asset['id']['id']
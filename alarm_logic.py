@@ -7,7 +7,7 @@ import os
 import logging
 import time
 import json
-from thingsboard_auth import get_admin_jwt 
+from thingsboard_auth import get_admin_jwt, invalidate_admin_jwt
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -84,6 +84,8 @@ def get_device_id(device_name: str, account_id: str) -> Optional[str]:
             logger.error(f"[DEVICE_LOOKUP] Failed to parse device ID: {e}")
     else:
         logger.error(f"[DEVICE_LOOKUP] Failed: {res.status_code} | {res.text}")
+        if res.status_code == 401:
+            invalidate_admin_jwt(account_id, host)
     return None
 
 def get_floor_boundaries(device_id: str, account_id: str) -> Optional[str]:
@@ -100,6 +102,8 @@ def get_floor_boundaries(device_id: str, account_id: str) -> Optional[str]:
                     return attr["value"]
         except Exception as e:
             logger.error(f"[ATTRIBUTES] Failed to parse attributes: {e}")
+    elif res.status_code == 401:
+        invalidate_admin_jwt(account_id, host)
     return None
 
 def create_alarm_on_tb(device_name: str, alarm_type: str, ts: int, severity: str, details: dict, account_id: str):
@@ -129,6 +133,8 @@ def create_alarm_on_tb(device_name: str, alarm_type: str, ts: int, severity: str
         logger.info(f"[ALARM] Created: {alarm_payload}")
     else:
         logger.error(f"[ALARM] Failed: {response.status_code} - {response.text}")
+        if response.status_code == 401:
+            invalidate_admin_jwt(account_id, host)
 
 def check_bucket_and_trigger(device: str, key: str, value: float, height: float, ts: int, floor: str, account_id: str):
     if device not in bucket_counts:
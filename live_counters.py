@@ -5,8 +5,9 @@ import math
 import logging
 from typing import Dict, Optional, Tuple
 
+import orjson
 import requests
-from thingsboard_auth import get_admin_jwt
+from thingsboard_auth import get_admin_jwt, invalidate_admin_jwt
 
 logger = logging.getLogger("live_counters")
 logging.basicConfig(level=logging.INFO)
@@ -67,9 +68,10 @@ def _parse_pack_out(v: str) -> Tuple[Optional[str], float, Optional[bool]]:
     if not v:
         return floor_label, height_mm, door_open
 
-    # Try JSON first
+    # Try JSON first (only worth a parse attempt when it looks like an object;
+    # the compact k=v form would just raise)
     try:
-        j = json.loads(v)
+        j = orjson.loads(v) if v.lstrip().startswith("{") else None
         if isinstance(j, dict):
             floor_label = (j.get("floor_label") or j.get("fl"))
             h_raw = j.get("height")
@@ -255,6 +257,10 @@ def flush_day_to_tb(date_str: str) -> int:
         )
         if r.status_code >= 400:
             logger.error("[LiveCounters] TB save_ts failed for %s (%s): %s", device_id, r.status_code, r.text)
+            if r.status_code == 401:
+                # Token revoked before its 'exp': log in again for the remaining devices
+                invalidate_admin_jwt()
+                jwt = get_admin_jwt()
             continue
 
         flushed += 1
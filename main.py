@@ -5,6 +5,7 @@ import threading
 import logging
 from typing import Dict, List, Optional
 
+import orjson
 import requests
 from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -86,7 +87,8 @@ def tb_get(base: str, path: str, jwt: str, params: Optional[dict] = None):
     r = requests.get(url, headers=headers, params=params or {}, timeout=20)
     if r.status_code >= 400:
         raise HTTPException(status_code=r.status_code, detail=f"TB GET {path} failed: {r.text}")
-    return r.json()
+    # Parse the raw bytes; skips requests' charset sniffing and str decode
+    return orjson.loads(r.content)
 
 def page_all(fn, *args, page_size=100):
     results = []
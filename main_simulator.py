@@ -3,14 +3,19 @@
 import os
 import time
 import random
+import logging
 import requests
 import concurrent.futures
+from dataclasses import dataclass, field
+from typing import Tuple
+from requests.adapters import HTTPAdapter
 from device_parser import parse_device_config
 
 # ThingsBoard host and simulation timing configuration
 TB_HOST = os.getenv("TB_HOST", "https://thingsboard.cloud")
 POST_TIMEOUT = float(os.getenv("TB_POST_TIMEOUT", "10"))
 TICK_SECONDS = float(os.getenv("SIM_TICK_SECONDS", "1.0"))
+HTTP_POOL_SIZE = int(os.getenv("SIM_HTTP_POOL_SIZE", "64"))
 
 # Sensor baseline ranges for simulated values
 VIBE_BASE = (0.02, 0.15)
@@ -18,24 +23,53 @@ JERK_BASE = (0.02, 0.15)
 TEMP_RANGE = (28.0, 36.0)
 HUMID_RANGE = (40.0, 65.0)
 MIC_RANGE = (30.0, 55.0)
-# main_simulator.py
 
-import os
-import time
-import random
-import requests
-import concurrent.futures
-from device_parser import parse_device_config
+logger = logging.getLogger("main_simulator")
 
-TB_HOST = os.getenv("TB_HOST", "https://thingsboard.cloud")
-POST_TIMEOUT = float(os.getenv("TB_POST_TIMEOUT", "10"))
-TICK_SECONDS = float(os.getenv("SIM_TICK_SECONDS", "1.0"))
+# One keep-alive session for every device: all POSTs go to the same TB host, so
+# reusing pooled connections avoids a TCP + TLS handshake per device per tick.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE))
 
-VIBE_BASE = (0.02, 0.15)
-JERK_BASE = (0.02, 0.15)
-TEMP_RANGE = (28.0, 36.0)
-HUMID_RANGE = (40.0, 65.0)
-MIC_RANGE = (30.0, 55.0)
+
+@dataclass(slots=True)
+class SimDevice:
+    """
+    Mutable per-device state for the full simulator.
+    Slots give fixed attribute offsets instead of a per-access dict hash.
+    """
+    token: str
+    floor_boundaries: Tuple[int, ...]
+    url: str
+    max_boundary: float
+    current_height_mm: float
+    current_floor_target_index: int
+    movement_speed_mm_per_tick: int
+    state: str = "MOVING"
+    door_timer: int = 0
+    is_door_open: bool = False
+    first_moving_tick_sent_close: bool = False
+    # Reused for every POST from this device; only its owning worker touches it
+    payload_buf: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, d: dict) -> "SimDevice":
+        """
+        Build simulator state from one parse_device_config() entry.
+        """
+        boundaries = tuple(d["floor_boundaries"])
+        return cls(
+            token=d["token"],
+            floor_boundaries=boundaries,
+            url=tb_url_for_token(d["token"]),
+            max_boundary=boundaries[-1],
+            current_height_mm=d.get("current_height_mm", boundaries[0]),
+            current_floor_target_index=d.get("current_floor_target_index", 0),
+            movement_speed_mm_per_tick=max(50, d.get("movement_speed_mm_per_tick", 200)),
+            door_timer=d.get("door_timer", 0),
+            is_door_open=d.get("is_door_open", False),
+        )
 
 
 def choose_csv_file(folder=".", extension=".csv"):
@@ -72,14 +106,44 @@ def tb_url_for_token(token: str) -> str:
 def send_json(url: str, payload: dict):
     """
     Send a JSON payload to the specified ThingsBoard URL.
-    Prints the response status and a snippet of the response text.
+    Payload/response are logged at DEBUG (set SIM_LOG_LEVEL=DEBUG to see them);
+    only failures are logged at WARNING, so the per-tick hot path stays quiet.
     """
-    print("Sending payload:", payload)
+    logger.debug("Sending payload: %s", payload)
     try:
-        r = requests.post(url, headers={"Content-Type": "application/json"}, json=payload, timeout=POST_TIMEOUT)
-        print("Response:", r.status_code, r.text[:200])
+        r = _SESSION.post(url, json=payload, timeout=POST_TIMEOUT)
+        if r.status_code >= 400:
+            logger.warning("Response: %s %s", r.status_code, r.text[:200])
+        else:
+            logger.debug("Response: %s %s", r.status_code, r.text[:200])
     except requests.RequestException as e:
-        print("Failed to send:", e)
+        logger.warning("Failed to send: %s", e)
+
+
+class TelemetryPoster:
+    """
+    Fire-and-forget telemetry sender for the alarm tester's timed loops.
+    submit() hands the POST to a background worker (sharing the pooled session)
+    and returns immediately, so time.sleep() alone sets the scenario cadence.
+    One worker by default: POSTs go out in submit order, so door OPEN/CLOSE
+    events cannot reach TB reordered behind a stalled request.
+    """
+
+    def __init__(self, max_workers: int = 1):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = []
+
+    def submit(self, url: str, payload: dict):
+        self._pending.append(self._executor.submit(send_json, url, payload))
+
+    def drain(self):
+        """Block until every submitted POST has completed."""
+        concurrent.futures.wait(self._pending)
+        self._pending.clear()
+
+    def close(self):
+        self.drain()
+        self._executor.shutdown(wait=True)
 
 
 def height_to_laser_val(height_mm: float, max_boundary: float) -> float:
@@ -102,21 +166,28 @@ def random_noise(lo_hi):
     return round(random.uniform(lo, hi), 4)
 
 
+def fill_sensor_payload(buf: dict) -> dict:
+    """
+    Overwrite the simulated sensor readings in `buf` in place and return it.
+    Lets the full simulator reuse one dict per device instead of allocating per POST.
+    """
+    buf["accel_x_val"] = random_noise(VIBE_BASE)
+    buf["accel_y_val"] = random_noise(VIBE_BASE)
+    buf["accel_z_val"] = random_noise(VIBE_BASE)
+    buf["gyro_x_val"] = random_noise(JERK_BASE)
+    buf["gyro_y_val"] = random_noise(JERK_BASE)
+    buf["gyro_z_val"] = random_noise(JERK_BASE)
+    buf["mpu_temp_val"] = round(random.uniform(*TEMP_RANGE), 2)
+    buf["humidity_val"] = round(random.uniform(*HUMID_RANGE), 2)
+    buf["mic_val"] = round(random.uniform(*MIC_RANGE), 2)
+    return buf
+
+
 def base_sensor_payload():
     """
     Generate a dictionary of simulated sensor readings for a lift device.
     """
-    return {
-        "accel_x_val": random_noise(VIBE_BASE),
-        "accel_y_val": random_noise(VIBE_BASE),
-        "accel_z_val": random_noise(VIBE_BASE),
-        "gyro_x_val":  random_noise(JERK_BASE),
-        "gyro_y_val":  random_noise(JERK_BASE),
-        "gyro_z_val":  random_noise(JERK_BASE),
-        "mpu_temp_val": round(random.uniform(*TEMP_RANGE), 2),
-        "humidity_val": round(random.uniform(*HUMID_RANGE), 2),
-        "mic_val": round(random.uniform(*MIC_RANGE), 2)
-    }
+    return fill_sensor_payload({})
 
 
 def run_alarm_tester():
@@ -173,6 +244,7 @@ def run_alarm_tester():
     print("15 - Combined Multi-Floor Door Cycles")
 
     choice = input("Enter a number (1-15): ").strip()
+    poster = TelemetryPoster()
 
     def gen_laser_for_height(h):
         return height_to_laser_val(h, max_boundary)
@@ -248,25 +320,25 @@ def run_alarm_tester():
             "door_val": "OPEN",
             "laser_val": gen_laser_for_height(4000)
         })
-        send_json(url, open_payload)
+        poster.submit(url, open_payload)
         for _ in range(16):
             tick_payload = base_sensor_payload()
             tick_payload.update({"laser_val": gen_laser_for_height(4000)})
-            send_json(url, tick_payload)
+            poster.submit(url, tick_payload)
             time.sleep(1)
         close_payload = base_sensor_payload()
         close_payload.update({
             "door_val": "CLOSE",
             "laser_val": gen_laser_for_height(4000)
         })
-        send_json(url, close_payload)
+        poster.submit(url, close_payload)
 
     elif choice == "8":
         print("Simulating idle lift at fixed height for 5 minutes...")
         for _ in range(300):
             payload = base_sensor_payload()
             payload.update({"laser_val": gen_laser_for_height(4000), "door_val": "CLOSE"})
-            send_json(url, payload)
+            poster.submit(url, payload)
             time.sleep(1)
 
     elif choice == "9":
@@ -303,7 +375,7 @@ def run_alarm_tester():
         for _ in range(180):
             payload = base_sensor_payload()
             payload.update({"laser_val": gen_laser_for_height(height), "door_val": "CLOSE"})
-            send_json(url, payload)
+            poster.submit(url, payload)
             time.sleep(1)
 
     elif choice == "12":
@@ -313,7 +385,7 @@ def run_alarm_tester():
         for _ in range(180):
             payload = base_sensor_payload()
             payload.update({"laser_val": gen_laser_for_height(height), "door_val": "CLOSE"})
-            send_json(url, payload)
+            poster.submit(url, payload)
             time.sleep(1)
 
     elif choice == "13":
@@ -323,11 +395,11 @@ def run_alarm_tester():
             for _ in range(5):
                 open_payload = base_sensor_payload()
                 open_payload.update({"door_val": "OPEN", "laser_val": gen_laser_for_height(height)})
-                send_json(url, open_payload)
+                poster.submit(url, open_payload)
                 time.sleep(2)
                 close_payload = base_sensor_payload()
                 close_payload.update({"door_val": "CLOSE", "laser_val": gen_laser_for_height(height)})
-                send_json(url, close_payload)
+                poster.submit(url, close_payload)
                 time.sleep(1)
         print("Completed door open/close count simulation.")
 
@@ -337,11 +409,11 @@ def run_alarm_tester():
             print(f"Floor {floor_index}: door open 10s")
             open_payload = base_sensor_payload()
             open_payload.update({"door_val": "OPEN", "laser_val": gen_laser_for_height(height)})
-            send_json(url, open_payload)
+            poster.submit(url, open_payload)
             time.sleep(10)
             close_payload = base_sensor_payload()
             close_payload.update({"door_val": "CLOSE", "laser_val": gen_laser_for_height(height)})
-            send_json(url, close_payload)
+            poster.submit(url, close_payload)
             time.sleep(2)
         print("Completed door open duration simulation.")
 
@@ -352,17 +424,20 @@ def run_alarm_tester():
                 print(f"Cycle {cycle+1}, Floor {floor_index}")
                 open_payload = base_sensor_payload()
                 open_payload.update({"door_val": "OPEN", "laser_val": gen_laser_for_height(height)})
-                send_json(url, open_payload)
+                poster.submit(url, open_payload)
                 time.sleep(5)
                 close_payload = base_sensor_payload()
                 close_payload.update({"door_val": "CLOSE", "laser_val": gen_laser_for_height(height)})
-                send_json(url, close_payload)
+                poster.submit(url, close_payload)
                 time.sleep(2)
         print("Completed combined multi-floor simulation.")
 
     else:
         print("Invalid choice.")
 
+    # Wait for any queued POSTs from the timed scenarios before returning
+    poster.close()
+
 
 def run_full_simulator():
     """
@@ -373,121 +448,103 @@ def run_full_simulator():
     # Initialize device state for simulation
     selected_csv = choose_csv_file()
     print(f"\nStarting simulator using: {selected_csv}")
-    devices = parse_device_config(selected_csv)
-
-    for d in devices:
-        d.setdefault("current_height_mm", d['floor_boundaries'][0])
-        d.setdefault("current_floor_target_index", 0)
-        d.setdefault("movement_speed_mm_per_tick", max(50, d.get("movement_speed_mm_per_tick", 200)))
-        d["state"] = d.get("state", "MOVING")
-        d["door_timer"] = d.get("door_timer", 0)
-        d["is_door_open"] = d.get("is_door_open", False)
-        d["first_moving_tick_sent_close"] = False
+    devices = [SimDevice.from_config(d) for d in parse_device_config(selected_csv)]
 
     def pick_next_target(device):
         # Randomly pick next floor target (30% random, else sequential)
         if random.random() < 0.3:
-            device["current_floor_target_index"] = random.randint(0, len(device["floor_boundaries"]) - 1)
+            device.current_floor_target_index = random.randint(0, len(device.floor_boundaries) - 1)
         else:
-            device["current_floor_target_index"] = (device["current_floor_target_index"] + 1) % len(device["floor_boundaries"])
+            device.current_floor_target_index = (device.current_floor_target_index + 1) % len(device.floor_boundaries)
 
     def send_telemetry(device):
-        # Send telemetry for a single device for one tick
-        url = tb_url_for_token(device['token'])
+        # Send telemetry for a single device for one tick.
+        # State is hoisted into locals on entry and written back once on exit.
+        url = device.url
         logs = []
-        max_boundary = device['floor_boundaries'][-1]
-
-        state = device["state"]
-        current = device["current_height_mm"]
-        target = device["floor_boundaries"][device["current_floor_target_index"]]
-        speed = device["movement_speed_mm_per_tick"]
-
-        def post_height_only():
-            """
-            Send periodic tick telemetry with current height and door state.
-            Always includes door_val for rule chain logic.
-            """
-        # Handle MOVING state: move towards target, send door closed, open door on arrival
-        # Handle DOOR_OPEN state: decrement timer, close door and pick next target when timer expires
-        # Always send periodic tick telemetry
-    # Main simulation loop: send telemetry for all devices every tick
-            """Always include door_val on every tick."""
-            door_state = "OPEN" if device["is_door_open"] else "CLOSE"
-            payload = base_sensor_payload()
-            payload.update({
-                "laser_val": height_to_laser_val(device["current_height_mm"], max_boundary),
-                "door_val": door_state
-            })
-            try:
-                requests.post(url, json=payload, headers={'Content-Type': 'application/json'}, timeout=POST_TIMEOUT)
-                logs.append(f"Height tick: {payload}")
-            except Exception as e:
-                logs.append(f"Height send error: {e}")
+        max_boundary = device.max_boundary
+
+        state = device.state
+        current = device.current_height_mm
+        target = device.floor_boundaries[device.current_floor_target_index]
+        speed = device.movement_speed_mm_per_tick
+        is_open = device.is_door_open
+        first_sent = device.first_moving_tick_sent_close
+        timer = device.door_timer
+        buf = device.payload_buf
+
+        def fill(door_val, height):
+            # Refresh the reusable payload; send_json serializes it before returning
+            fill_sensor_payload(buf)
+            buf["door_val"] = door_val
+            buf["laser_val"] = height_to_laser_val(height, max_boundary)
+            return buf
 
+        # Handle MOVING state: move towards target, send door closed, open door on arrival
         if state == "MOVING":
             # Ensure door is marked closed when we start/continue moving
-            if not device["first_moving_tick_sent_close"]:
-                device["is_door_open"] = False  # keep flags consistent
-                p = base_sensor_payload()
-                p.update({
-                    "door_val": "CLOSE",
-                    "laser_val": height_to_laser_val(current, max_boundary)
-                })
-                send_json(url, p)
-                device["first_moving_tick_sent_close"] = True
+            if not first_sent:
+                is_open = False  # keep flags consistent
+                send_json(url, fill("CLOSE", current))
+                first_sent = True
 
             # Move towards target
             if current < target:
-                device["current_height_mm"] = min(current + speed, target)
+                current = min(current + speed, target)
             elif current > target:
-                device["current_height_mm"] = max(current - speed, target)
+                current = max(current - speed, target)
 
             # Arrived at floor -> open door
-            if abs(device["current_height_mm"] - target) <= speed * 0.001:
-                device["current_height_mm"] = target
-                device["state"] = "DOOR_OPEN"
-                device["door_timer"] = random.randint(5, 10)
-                device["is_door_open"] = True
-                device["first_moving_tick_sent_close"] = False
-                p = base_sensor_payload()
-                p.update({
-                    "door_val": "OPEN",
-                    "laser_val": height_to_laser_val(device["current_height_mm"], max_boundary)
-                })
-                send_json(url, p)
+            if abs(current - target) <= speed * 0.001:
+                current = target
+                state = "DOOR_OPEN"
+                timer = random.randint(5, 10)
+                is_open = True
+                first_sent = False
+                send_json(url, fill("OPEN", current))
 
+        # Handle DOOR_OPEN state: decrement timer, close door and pick next target when timer expires
         elif state == "DOOR_OPEN":
-            device["door_timer"] -= 1
-            if device["door_timer"] <= 0:
+            timer -= 1
+            if timer <= 0:
                 # Close and start moving again
-                device["is_door_open"] = False
-                p = base_sensor_payload()
-                p.update({
-                    "door_val": "CLOSE",
-                    "laser_val": height_to_laser_val(device["current_height_mm"], max_boundary)
-                })
-                send_json(url, p)
+                is_open = False
+                send_json(url, fill("CLOSE", current))
                 pick_next_target(device)
-                device["state"] = "MOVING"
-                device["first_moving_tick_sent_close"] = True
-
-        # Always send the periodic tick ninirirnoor_val included
-        post_height_only()
+                state = "MOVING"
+                first_sent = True
+
+        device.state = state
+        device.current_height_mm = current
+        device.is_door_open = is_open
+        device.door_timer = timer
+        device.first_moving_tick_sent_close = first_sent
+
+        # Always send the periodic tick; door_val is included for rule chain logic
+        payload = fill("OPEN" if is_open else "CLOSE", current)
+        try:
+            _SESSION.post(url, json=payload, timeout=POST_TIMEOUT)
+            logs.append(f"Height tick: {payload}")
+        except Exception as e:
+            logs.append(f"Height send error: {e}")
 
         return "\n".join(logs)
 
-    while True:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as executor:
+    # Keep the worker threads (and their pooled connections) alive across ticks
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(devices), HTTP_POOL_SIZE)) as executor:
+        while True:
             results = list(executor.map(send_telemetry, devices))
-        print("=" * 50)
-        print(f" Tick @ {time.strftime('%H:%M:%S')}")
-        for i, output in enumerate(results):
-            print(f"[Device {i+1:02d}] {output}")
-        print("=" * 50)
-        time.sleep(TICK_SECONDS)
+            print("=" * 50)
+            print(f" Tick @ {time.strftime('%H:%M:%S')}")
+            for i, output in enumerate(results):
+                print(f"[Device {i+1:02d}] {output}")
+            print("=" * 50)
+            time.sleep(TICK_SECONDS)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("SIM_LOG_LEVEL", "WARNING").upper())
+
     # Entry point: prompt user for mode (full simulator or alarm tester)
     print("Select Mode:")
     print("1 - Run Full Simulator")
@@ -1,15 +1,16 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Iterable, Optional, Set
+import math
+from typing import Any, Dict, FrozenSet, Iterable, Optional
 
 
 
-DEFAULT_INT_KEYS: Set[str] = {
+DEFAULT_INT_KEYS: FrozenSet[str] = frozenset({
     "v", "ts", "fi", "door", "home_floor",
     # add more device-int fields here if the firmware includes them as ints
-}
+})
 
-DEFAULT_FLOAT_KEYS: Set[str] = {
+DEFAULT_FLOAT_KEYS: FrozenSet[str] = frozenset({
     # Heights & sensors (raw)
     "h", "laser_val", "height_raw",
     "accel_x_val", "accel_y_val", "accel_z_val",
@@ -21,7 +22,7 @@ DEFAULT_FLOAT_KEYS: Set[str] = {
     "temperature", "humidity", "sound_level",
     # Any other continuous numeric fields you might include:
     "vel",
-}
+})
 
 __all__ = [
     "parse_pack_raw",
@@ -55,20 +56,6 @@ def _to_float(v: str) -> Optional[float]:
         return None
 
 
-def _coerce_value(key: str, val: str,
-                  int_keys: Set[str],
-                  float_keys: Set[str]) -> Any:
-    if val == "":
-        return None
-    if key in int_keys:
-        n = _to_int(val)
-        return n if n is not None else val
-    if key in float_keys:
-        f = _to_float(val)
-        return f if f is not None else val
-    return val
-
-
 # --- Public API ---------------------------------------------------------------
 
 def parse_pack_raw(
@@ -94,29 +81,41 @@ def parse_pack_raw(
     if not s:
         return {}
 
-    ik: Set[str] = set(DEFAULT_INT_KEYS)
-    fk: Set[str] = set(DEFAULT_FLOAT_KEYS)
-    if int_keys:
-        ik |= set(int_keys)
-    if float_keys:
-        fk |= set(float_keys)
+    # Common case (no overrides) reuses the module-level frozensets as-is
+    ik: FrozenSet[str] = DEFAULT_INT_KEYS | frozenset(int_keys) if int_keys else DEFAULT_INT_KEYS
+    fk: FrozenSet[str] = DEFAULT_FLOAT_KEYS | frozenset(float_keys) if float_keys else DEFAULT_FLOAT_KEYS
 
     out: Dict[str, Any] = {}
-    # Fast path split; tolerant to malformed segments
+    # One pass per segment with coercion inlined (this runs once per telemetry
+    # point); tolerant to malformed segments
     for pair in s.split("|"):
-        if not pair:
-            continue
         # Only split on the first '=' to allow '=' inside values (rare)
-        eq = pair.find("=")
-        if eq < 0:
+        k, eq, v = pair.partition("=")
+        if not eq:
             continue
-        k = pair[:eq].strip()
-        v = pair[eq + 1:].strip()
+        k = k.strip()
         if not k:
             continue
         if lowercase_keys:
             k = k.lower()
-        out[k] = _coerce_value(k, v, ik, fk)
+        v = v.strip()
+        if not v:
+            out[k] = None
+        elif k in ik:
+            try:
+                out[k] = int(v)
+            except ValueError:
+                out[k] = v
+        elif k in fk:
+            try:
+                f = float(v)
+            except ValueError:
+                out[k] = v
+            else:
+                # NaN/inf stay as the raw string
+                out[k] = f if math.isfinite(f) else v
+        else:
+            out[k] = v
     return out
 
 
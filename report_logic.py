@@ -1,18 +1,28 @@
 # report_logic.py
 import os
 import re
-import time
-import json
-import uuid
 import math
+import time
+import hashlib
+import stat
 import logging
-from datetime import datetime, date, timedelta
-from typing import List, Optional, Any, Dict, Tuple
-
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, date, time as _time
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Callable, List, Optional, Any, Dict, Mapping, Tuple
+
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import xlsxwriter
 from fastapi import APIRouter, Header, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from pydantic import BaseModel, Field, field_validator
 
 # Shared parser for packed strings
@@ -25,12 +35,24 @@ router = APIRouter()
 REPORT_DIR = os.getenv("REPORT_DIR", "/tmp")
 os.makedirs(REPORT_DIR, exist_ok=True)
 
+# Recently generated reports are also kept in memory (LRU, capped by total bytes)
+# so repeat downloads skip the disk and survive /tmp being wiped.
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Output format -> media type. CSV is the escape hatch for reports past Excel's row cap.
+REPORT_FORMATS = {
+    "xlsx": XLSX_MEDIA_TYPE,
+    "csv": "text/csv",
+}
+_EXCEL_MAX_ROWS = 1048576
+
 # --- ThingsBoard account routing (multi-tenant) --------------------------------
 def _load_tb_accounts() -> Dict[str, str]:
     raw = os.getenv("TB_ACCOUNTS", "").strip()
     if raw:
         try:
-            data = json.loads(raw)
+            data = orjson.loads(raw)
             if isinstance(data, dict) and data:
                 return {str(k): str(v) for k, v in data.items()}
         except Exception as e:
@@ -49,8 +71,16 @@ def _choose_base_url(x_tb_account: Optional[str]) -> str:
             return TB_ACCOUNTS[x_tb_account.lower()]
     return next(iter(TB_ACCOUNTS.values()))
 
+_DAY_MS = 24 * 60 * 60 * 1000
+_MIDNIGHT = _time(0, 0)
+_UNSAFE_RE = re.compile(r"[^A-Za-z0-9._-]+")
+_SAFE_FILENAME_RE = re.compile(r"[A-Za-z0-9._-]+")
+# Files this module writes (plus their in-progress temp names); the janitor never
+# touches anything else in REPORT_DIR
+_REPORT_FILE_RE = re.compile(r"\.?[A-Za-z0-9._-]+_[0-9a-f]{16}\.(?:xlsx|csv)(?:\.part)?")
+
 # --- Input types ---------------------------------------------------------------
-ALLOWED_TYPES = {
+ALLOWED_TYPES = frozenset({
     "height",
     "direction",
     "lift_status",
@@ -62,9 +92,49 @@ ALLOWED_TYPES = {
     "x_jerk",
     "y_jerk",
     "z_jerk",
-}
+})
 
 # --- Helpers: date/time parsing ------------------------------------------------
+def _epoch_to_date(x: int) -> date:
+    # assume ms if it's too large
+    if x > 10_000_000_000:
+        return datetime.utcfromtimestamp(x / 1000.0).date()
+    return datetime.utcfromtimestamp(x).date()
+
+def _is_ymd(s: str) -> bool:
+    # Shape check only; date.fromisoformat does the digit/range validation.
+    # (It would also accept week dates and basic YYYYMMDD, so gate it.)
+    return len(s) == 10 and s[4] == "-" and s[7] == "-"
+
+@lru_cache(maxsize=1024)
+def _parse_date_str(s: str) -> date:
+    """
+    String branch of _parse_any_date. Cached: a burst of report requests
+    usually repeats the same couple of dates.
+    """
+    # Fast path: the widget almost always sends 'YYYY-MM-DD'
+    if _is_ymd(s):
+        return date.fromisoformat(s)
+
+    s = s.strip()
+
+    # digit string → epoch
+    if s.isdigit():
+        return _epoch_to_date(int(s))
+
+    # YYYY-MM-DD (with surrounding whitespace)
+    if _is_ymd(s):
+        return date.fromisoformat(s)
+
+    # ISO datetime (3.11+ fromisoformat takes a trailing 'Z' and most ISO 8601 forms)
+    try:
+        dt = datetime.fromisoformat(s)
+        return dt.date()
+    except Exception:
+        pass
+
+    raise ValueError(f"unrecognized date format: {s!r}")
+
 def _parse_any_date(val: Any) -> date:
     """
     Accept:
@@ -76,33 +146,17 @@ def _parse_any_date(val: Any) -> date:
     if val is None or val == "":
         raise ValueError("missing date")
 
+    if isinstance(val, str):
+        return _parse_date_str(val)
+
     # int-like → epoch
-    if isinstance(val, (int, float)) or (isinstance(val, str) and val.isdigit()):
-        x = int(val)
-        # assume ms if it's too large
-        if x > 10_000_000_000:
-            dt = datetime.utcfromtimestamp(x / 1000.0)
-        else:
-            dt = datetime.utcfromtimestamp(x)
-        return dt.date()
+    if isinstance(val, (int, float)):
+        return _epoch_to_date(int(val))
 
     if isinstance(val, date) and not isinstance(val, datetime):
         return val
 
-    s = str(val).strip()
-
-    # YYYY-MM-DD
-    if re.match(r"^\d{4}-\d{2}-\d{2}$", s):
-        return datetime.strptime(s, "%Y-%m-%d").date()
-
-    # ISO datetime
-    try:
-        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
-        return dt.date()
-    except Exception:
-        pass
-
-    raise ValueError(f"unrecognized date format: {val!r}")
+    return _parse_date_str(str(val))
 
 # --- Request model -------------------------------------------------------------
 class ReportRequest(BaseModel):
@@ -111,6 +165,7 @@ class ReportRequest(BaseModel):
     include_alarms: bool = Field(True, alias="includeAlarms")
     start_date: Any = Field(..., alias="startDate")  # date-like
     end_date: Any = Field(..., alias="endDate")      # date-like
+    report_format: str = Field("xlsx", alias="format")  # xlsx | csv
 
     model_config = {
         "populate_by_name": True,
@@ -123,62 +178,128 @@ class ReportRequest(BaseModel):
     def _coerce_dates(cls, v):
         return _parse_any_date(v)
 
+    @field_validator("report_format", mode="after")
+    @classmethod
+    def _check_format(cls, v: str):
+        v = v.strip().lower()
+        if v not in REPORT_FORMATS:
+            raise ValueError(f"format must be one of: {', '.join(REPORT_FORMATS)}")
+        return v
+
     @field_validator("data_types", mode="after")
     @classmethod
     def _filter_types(cls, v: List[str]):
         if not v:
             raise ValueError("data_types cannot be empty")
-        filtered = [t for t in v if t in ALLOWED_TYPES]
+        # Filter + deduplicate in one pass, preserving order (dicts keep insertion order)
+        filtered = list({t: None for t in v if t in ALLOWED_TYPES})
         if not filtered:
             raise ValueError("No valid data_types provided")
-        # Deduplicate while preserving order
-        seen = set()
-        result = []
-        for t in filtered:
-            if t not in seen:
-                seen.add(t)
-                result.append(t)
-        return result
+        return filtered
+
+class ReportResponse(BaseModel):
+    filename: str
+    download_url: str
+    status_url: str
 
 # --- TB REST helpers -----------------------------------------------------------
+# Timeseries windows are fetched concurrently; one shared keep-alive session sized
+# to match, so chunk requests reuse TCP/TLS connections instead of reconnecting.
+# Transient gateway errors are retried with a short backoff; once retries run out
+# the last response is returned and mapped to HTTPException as usual.
+TB_FETCH_CONCURRENCY = max(1, int(os.getenv("TB_FETCH_CONCURRENCY", "8")))
+
+_tb_session = requests.Session()
+_tb_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=max(32, TB_FETCH_CONCURRENCY * 2),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False,
+    ),
+)
+_tb_session.mount("http://", _tb_adapter)
+_tb_session.mount("https://", _tb_adapter)
+_tb_fetch_executor = ThreadPoolExecutor(max_workers=TB_FETCH_CONCURRENCY, thread_name_prefix="tb-fetch")
+
 def _tb_headers(jwt: str) -> Dict[str, str]:
     return {"X-Authorization": f"Bearer {jwt}"}
 
 def _tb_get(base: str, path: str, jwt: str, params: Optional[dict] = None):
     url = f"{base.rstrip('/')}{path}"
-    r = requests.get(url, headers=_tb_headers(jwt), params=params or {}, timeout=30)
+    r = _tb_session.get(url, headers=_tb_headers(jwt), params=params or {}, timeout=30)
     if r.status_code >= 400:
         raise HTTPException(status_code=r.status_code, detail=f"TB GET {path} failed: {r.text}")
+    # Timeseries chunks run to several MB; orjson parses the raw bytes directly
     try:
-        return r.json()
-    except Exception:
+        return orjson.loads(r.content)
+    except orjson.JSONDecodeError:
         return r.text
 
-def _page_all(fn, *args, page_size=100):
-    results = []
-    page = 0
-    while True:
-        data = fn(page=page, pageSize=page_size, *args)
-        if isinstance(data, dict):
-            chunk = data.get("data") or []
-            if isinstance(chunk, list):
-                results.extend(chunk)
-            has_next = data.get("hasNext", False)
-            if not has_next:
-                break
-            page += 1
-        else:
-            break
-    return results
+# --- Lookup caches -------------------------------------------------------------
+# Device name -> UUID is effectively immutable, so repeat reports skip the lookup
+# round-trips. Names are only unique within a tenant/customer, so the id is cached
+# per caller (full JWT) as well; /api/auth/user is cached briefly the same way
+# (token prefixes are shared by every token from the same issuer, so never key on
+# a prefix).
+DEVICE_ID_CACHE_TTL = float(os.getenv("DEVICE_ID_CACHE_TTL", "3600"))
+AUTH_USER_CACHE_TTL = 60.0
+_LOOKUP_CACHE_MAX = 1024
+
+_device_id_cache: "OrderedDict[Tuple[str, str, str], Tuple[float, str]]" = OrderedDict()
+_auth_user_cache: "OrderedDict[Tuple[str, str], Tuple[float, dict]]" = OrderedDict()
+_lookup_cache_lock = threading.Lock()
+
+def _ttl_get(cache: OrderedDict, key):
+    now = time.monotonic()
+    with _lookup_cache_lock:
+        hit = cache.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= now:
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return hit[1]
+
+def _ttl_put(cache: OrderedDict, key, value, ttl: float) -> None:
+    with _lookup_cache_lock:
+        cache[key] = (time.monotonic() + ttl, value)
+        cache.move_to_end(key)
+        while len(cache) > _LOOKUP_CACHE_MAX:
+            cache.popitem(last=False)
+
+def _invalidate_device_id(base: str, jwt: str, device_name: str) -> None:
+    with _lookup_cache_lock:
+        _device_id_cache.pop((base, jwt, device_name), None)
+
+def _get_auth_user(base: str, jwt: str) -> dict:
+    me = _ttl_get(_auth_user_cache, (base, jwt))
+    if me is None:
+        me = _tb_get(base, "/api/auth/user", jwt)
+        if isinstance(me, dict):
+            _ttl_put(_auth_user_cache, (base, jwt), me, AUTH_USER_CACHE_TTL)
+    return me
+
+def _resolve_device_id(base: str, jwt: str, device_name: str) -> Optional[str]:
+    did = _ttl_get(_device_id_cache, (base, jwt, device_name))
+    if did is None:
+        did = _find_device_id(base, jwt, device_name)
+        if did:
+            _ttl_put(_device_id_cache, (base, jwt, device_name), did, DEVICE_ID_CACHE_TTL)
+    return did
 
 def _find_device_id(base: str, jwt: str, device_name: str) -> Optional[str]:
     """
     Robust device lookup that works for tenant admins and normal users.
-    Tries a few endpoints and falls back to listing visible devices.
+    Tries the tenant name lookup first, then a textSearch listing of visible devices.
     """
     # 1) Tenant admin direct lookup
     try:
-        data = _tb_get(base, f"/api/tenant/devices?deviceName={device_name}", jwt)
+        data = _tb_get(base, "/api/tenant/devices", jwt, params={"deviceName": device_name})
         if isinstance(data, dict):
             did = (data.get("id") or {}).get("id")
             if isinstance(did, str):
@@ -188,7 +309,7 @@ def _find_device_id(base: str, jwt: str, device_name: str) -> Optional[str]:
 
     # 2) List visible devices to the user and match by name
     try:
-        me = _tb_get(base, "/api/auth/user", jwt)
+        me = _get_auth_user(base, jwt)
         authority = str(me.get("authority", "")).upper()
         customer_obj = me.get("customerId") if isinstance(me.get("customerId"), dict) else None
         customer_id = (customer_obj or {}).get("id") if isinstance(customer_obj, dict) else None
@@ -204,21 +325,25 @@ def _find_device_id(base: str, jwt: str, device_name: str) -> Optional[str]:
             return out
 
         if authority == "TENANT_ADMIN":
-            def fetch_page(page=0, pageSize=100, **_):
-                return _tb_get(base, "/api/tenant/devices", jwt, params={"page": page, "pageSize": pageSize})
-            all_devices = _page_all(fetch_page)
+            path = "/api/tenant/devices"
         elif customer_id:
-            def fetch_page(page=0, pageSize=100, **_):
-                return _tb_get(base, f"/api/customer/{customer_id}/devices", jwt, params={"page": page, "pageSize": pageSize})
-            all_devices = _page_all(fetch_page)
+            path = f"/api/customer/{customer_id}/devices"
         else:
-            def fetch_page(page=0, pageSize=100, **_):
-                return _tb_get(base, "/api/user/devices", jwt, params={"page": page, "pageSize": pageSize})
-            all_devices = _page_all(fetch_page)
+            path = "/api/user/devices"
 
-        for d in normalize_devices(all_devices):
-            if d["name"] == device_name:
-                return d["id"]
+        # textSearch narrows the listing server-side; stop at the first exact match
+        page = 0
+        while True:
+            data = _tb_get(base, path, jwt, params={"page": page, "pageSize": 100, "textSearch": device_name})
+            if not isinstance(data, dict):
+                break
+            items = data.get("data") or []
+            for d in normalize_devices(items if isinstance(items, list) else []):
+                if d["name"] == device_name:
+                    return d["id"]
+            if not data.get("hasNext", False):
+                break
+            page += 1
     except Exception as e:
         logger.warning("Device lookup fallback failed: %s", e)
 
@@ -233,623 +358,536 @@ def _fetch_timeseries_chunks(
     end_ms: int,
     *,
     chunk_ms: int = 6 * 60 * 60 * 1000,   # 6 hours
-    per_call_limit: int = 20000
-) -> Dict[str, List[Dict[str, Any]]]:
+    per_call_limit: int = 20000,
+    on_not_found: Optional[Callable[[], None]] = None,
+    fallbacks: Optional[Dict[str, str]] = None,
+) -> pd.DataFrame:
     """
-    Fetch timeseries in chunks to avoid TB limits.
-    Returns dict: key -> list of {ts: ms, value: <str|num|bool>}
+    Fetch timeseries in chunks to avoid TB limits. Every (key, window) pair is
+    its own request, run concurrently (bounded by TB_FETCH_CONCURRENCY), so a
+    heavy key does not hold up the others; results merge in window order.
+    Returns one frame indexed by ts (ms, unsorted: the report sorts once after
+    merging sources) with a column per key; NaN where a key has no point at that ts.
+    A chunk that fails is skipped; `on_not_found` is called for each one that 404s.
+    `fallbacks` maps a key to a legacy key that is fetched only for the windows
+    where the key itself came back empty; it gets its own column when fetched.
     """
-    out: Dict[str, List[Dict[str, Any]]] = {k: [] for k in keys}
-    ks = ",".join(keys)
+    url = f"/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries"
+
+    windows = []
     cur = start_ms
     while cur <= end_ms:
         window_end = min(end_ms, cur + chunk_ms - 1)
+        windows.append((cur, window_end))
+        cur = window_end + 1
+
+    tasks = [(k, win) for win in windows for k in keys]
+
+    def fetch_task(task):
+        key, win = task
         params = {
-            "keys": ks,
-            "startTs": cur,
-            "endTs": window_end,
+            "keys": key,
+            "startTs": win[0],
+            "endTs": win[1],
             "limit": per_call_limit,
             "agg": "NONE",
-            "useStrictDataTypes": "false",
+            # Native JSON types: numbers stay numbers instead of being re-sent as strings
+            "useStrictDataTypes": "true",
         }
-        url = f"/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries"
         try:
-            data = _tb_get(base, url, jwt, params)
-            if isinstance(data, dict):
-                for k in keys:
-                    if k in data and isinstance(data[k], list):
-                        out[k].extend(data[k])
+            return _tb_get(base, url, jwt, params)
         except HTTPException as e:
             # If TB has no data for a chunk it may 404—tolerate by skipping
-            logger.info("TS fetch chunk %s-%s failed for %s: %s", cur, window_end, ks, e.detail)
-        cur = window_end + 1
-
-    # sort each key by ts ascending & de-dup (keep first seen ts)
-    for k in keys:
-        arr = out[k]
-        arr.sort(key=lambda x: int(x.get("ts", 0)))
-        dedup = []
-        seen_ts = set()
-        for p in arr:
+            logger.info("TS fetch chunk %s-%s failed for %s: %s", win[0], win[1], key, e.detail)
+            if e.status_code == 404 and on_not_found is not None:
+                on_not_found()
+            return None
+
+    def run(tasks):
+        if len(tasks) == 1:
+            return [fetch_task(tasks[0])]
+        return list(_tb_fetch_executor.map(fetch_task, tasks))
+
+    def points_of(key, data):
+        points = data.get(key) if isinstance(data, dict) else None
+        return points if isinstance(points, list) else []
+
+    results = run(tasks)
+    columns = list(keys)
+    if fallbacks:
+        retry = [
+            (fallbacks[k], win)
+            for (k, win), data in zip(tasks, results)
+            if k in fallbacks and not points_of(k, data)
+        ]
+        if retry:
+            tasks += retry
+            results += run(retry)
+            columns += [k for k in dict.fromkeys(k for k, _ in retry) if k not in columns]
+
+    # Pivot straight into key -> {ts: value}, coercing ts to int once at ingress.
+    # The first value seen for a (ts, key) wins, so de-duplication falls out of the
+    # dict, and no per-point row dict is allocated.
+    by_key: Dict[str, Dict[int, Any]] = {k: {} for k in columns}
+    for (k, _), data in zip(tasks, results):
+        col = by_key[k]
+        for p in points_of(k, data):
             ts = int(p.get("ts", 0))
-            if ts in seen_ts:
-                continue
-            seen_ts.add(ts)
-            dedup.append({"ts": ts, "value": p.get("value")})
-        out[k] = dedup
-    return out
+            if ts not in col:
+                col[ts] = p.get("value")
 
-# --- Mapping from packed strings to requested columns -------------------------
-def _extract_from_calc_like(pack: str, want: List[str]) -> Dict[str, Any]:
-    """
-    Parse one calc-like row (pack_calc or pack_out) and return dict of wanted fields.
-    Expected short keys: h (height), fi, fl, dir, st.
-    """
-    parsed = parse_pack_raw(pack)
-    out: Dict[str, Any] = {}
-    # height
-    if "height" in want:
-        out["height"] = parsed.get("h")
-    # direction (U/D/S or similar)
-    if "direction" in want:
-        out["direction"] = parsed.get("dir")
-    # lift_status (M/I -> moving/idle)
-    if "lift_status" in want:
-        st = str(parsed.get("st") or "")
-        out["lift_status"] = "moving" if st.upper() == "M" else ("idle" if st.upper() == "I" else "")
-    # floor index/label
-    if "current_floor_index" in want:
-        out["current_floor_index"] = parsed.get("fi")
-    if "current_floor_label" in want:
-        out["current_floor_label"] = parsed.get("fl")
-    return out
+    df = pd.DataFrame({k: pd.Series(col, dtype=object) for k, col in by_key.items()}, columns=columns)
+    df.index = df.index.astype("int64")
+    return df
 
-def _extract_from_pack_raw(pack: str, want: List[str]) -> Dict[str, Any]:
+def _ts_iso_column(ts_ms: pd.Index) -> pd.Index:
     """
-    Parse one pack_raw row and map accelerometer/gyro to vibe/jerk when requested.
+    Format epoch-ms timestamps as UTC ISO-8601 strings in one vectorized pass.
     """
-    parsed = parse_pack_raw(pack)
-    out: Dict[str, Any] = {}
-
-    def pick(mn: str, fallback: str):
-        v = parsed.get(mn)
-        if v is None:
-            v = parsed.get(fallback)
-        return v
-
-    if "x_vibe" in want:
-        out["x_vibe"] = pick("x_vibe", "accel_x_val")
-    if "y_vibe" in want:
-        out["y_vibe"] = pick("y_vibe", "accel_y_val")
-    if "z_vibe" in want:
-        out["z_vibe"] = pick("z_vibe", "accel_z_val")
-
-    if "x_jerk" in want:
-        out["x_jerk"] = pick("x_jerk", "gyro_x_val")
-    if "y_jerk" in want:
-        out["y_jerk"] = pick("y_jerk", "gyro_y_val")
-    if "z_jerk" in want:
-        out["z_jerk"] = pick("z_jerk", "gyro_z_val")
-
-    return out
+    return pd.to_datetime(ts_ms, unit="ms", utc=True).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
-# --- File helpers -------------------------------------------------------------
-def _safe_filename(base: str) -> str:
-    s = re.sub(r"[^A-Za-z0-9._-]+", "_", base).strip("._-")
-    return s or "report"
-
-def _make_filename(device_name: str, start: date, end: date) -> str:
-    base = _safe_filename(f"{device_name}_{start.isoformat()}_{end.isoformat()}")
-    return f"{base}_{uuid.uuid4().hex[:8]}.xlsx"
+# --- Mapping from packed strings to requested columns -------------------------
+# calc-like packs (pack_calc / pack_out): report column -> short key
+_CALC_FIELDS = {
+    "height": "h",
+    "direction": "dir",
+    "current_floor_index": "fi",
+    "current_floor_label": "fl",
+}
+_LIFT_STATUS = {"M": "moving", "I": "idle"}
+
+# pack_raw: report column -> firmware key used when the processed name is absent
+_RAW_FALLBACKS = {
+    "x_vibe": "accel_x_val",
+    "y_vibe": "accel_y_val",
+    "z_vibe": "accel_z_val",
+    "x_jerk": "gyro_x_val",
+    "y_jerk": "gyro_y_val",
+    "z_jerk": "gyro_z_val",
+}
 
-# --- Main endpoint ------------------------------------------------------------
-@router.post("/generate_report/")
-def generate_report(
-    body: ReportRequest,
-    authorization: Optional[str] = Header(None, alias="Authorization"),
-    x_tb_account: Optional[str] = Header(None, alias="X-TB-Account"),
-):
+# Large reports can parse their distinct packs on a process pool (parsing is
+# pure-Python CPU work, so threads would just contend for the GIL). Opt-in via
+# REPORT_PARSE_WORKERS>=2 on multi-core hosts; sources with few distinct packs
+# always parse inline where pickling would cost more, and any pool failure falls
+# back to inline.
+PARSE_WORKERS = int(os.getenv("REPORT_PARSE_WORKERS", "0"))
+PARSE_POOL_MIN_PACKS = int(os.getenv("REPORT_PARSE_POOL_MIN_PACKS", "50000"))
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pool_lock = threading.Lock()
+
+def _drop_parse_pool() -> None:
+    global _parse_pool
+    with _parse_pool_lock:
+        pool, _parse_pool = _parse_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    global _parse_pool
+    if PARSE_WORKERS < 2:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn, not fork: the server process is multi-threaded
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _parse_pool
+
+@lru_cache(maxsize=8192)
+def _parse_pack_cached(pack: str) -> Mapping[str, Any]:
     """
-    Generate an Excel report for the requested device and fields.
-    - Pulls telemetry from TB using the caller's JWT.
-    - Parses 'pack_calc' and/or 'pack_out' for calculated fields; 'pack_raw' for raw fields.
-    - Spreads requested keys into separate columns.
-    - Returns {filename, download_url}.
+    parse_pack_raw memoized per packed string (an idle lift repeats the same pack
+    for minutes). Read-only, since every hit shares the one cached dict.
     """
-    if not authorization or not authorization.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
-    jwt = authorization.split(" ", 1)[1].strip()
-    if not jwt:
-        raise HTTPException(status_code=401, detail="Empty JWT")
-
-    if body.end_date < body.start_date:
-        raise HTTPException(status_code=400, detail="end_date cannot be before start_date")
+    return MappingProxyType(parse_pack_raw(pack))
 
-    base = _choose_base_url(x_tb_account)
-    logger.info(
-        "[/generate_report] device=%s types=%s include_alarms=%s start=%s end=%s base=%s",
-        body.device_name, body.data_types, body.include_alarms, body.start_date, body.end_date, base,
-    )
-
-    # Resolve device id
-    device_id = _find_device_id(base, jwt, body.device_name)
-    if not device_id:
-        raise HTTPException(status_code=404, detail=f"Device '{body.device_name}' not found or not visible to this user")
-
-    # Build time window in ms (full days inclusive, UTC)
-    start_dt = datetime.combine(body.start_date, datetime.min.time())
-    end_dt = datetime.combine(body.end_date, datetime.max.time().replace(microsecond=0))
-    start_ms = int(start_dt.timestamp() * 1000)
-    end_ms = int(end_dt.timestamp() * 1000)
-
-    # Decide which keys to fetch from TB time-series
-    need_calc = any(k in body.data_types for k in ("height", "direction", "lift_status", "current_floor_index", "current_floor_label"))
-    need_raw  = any(k in body.data_types for k in ("x_vibe", "y_vibe", "z_vibe", "x_jerk", "y_jerk", "z_jerk"))
-
-    keys: List[str] = []
-    if need_calc:
-        # Your rule chain currently saves 'pack_out'; include 'pack_calc' for backward compatibility.
-        keys.extend(["pack_out", "pack_calc"])
-    if need_raw:
-        keys.append("pack_raw")
-
-    if not keys:
-        raise HTTPException(status_code=400, detail="No fetchable keys for the selected data_types")
-
-    # Pull telemetry in chunks
-    ts_data = _fetch_timeseries_chunks(base, jwt, device_id, keys, start_ms, end_ms)
-
-    # Build rows by TB timestamp (ms)
-    rows_by_ts: Dict[int, Dict[str, Any]] = {}
-
-    def ensure_row(ts_ms: int) -> Dict[str, Any]:
-        r = rows_by_ts.get(ts_ms)
-        if r is None:
-            r = {"ts_ms": ts_ms, "ts_iso": datetime.utcfromtimestamp(ts_ms / 1000.0).isoformat() + "Z"}
-            rows_by_ts[ts_ms] = r
-        return r
-
-    # Prefer pack_out (new) but also accept pack_calc (legacy) for calculated fields
-    if need_calc:
-        for key in ("pack_out", "pack_calc"):
-            for p in ts_data.get(key, []):
-                ts_ms = int(p["ts"])
-                val = p.get("value")
-                if not isinstance(val, str):
-                    continue
-                out = _extract_from_calc_like(val, body.data_types)
-                if out:
-                    row = ensure_row(ts_ms)
-                    row.update(out)
-
-    if need_raw:
-        for p in ts_data.get("pack_raw", []):
-            ts_ms = int(p["ts"])
-            val = p.get("value")
-            if not isinstance(val, str):
-                continue
-            out = _extract_from_pack_raw(val, body.data_types)
-            if out:
-                row = ensure_row(ts_ms)
-                row.update(out)
-
-    # Assemble DataFrame
-    if not rows_by_ts:
-        # Produce an empty but valid file (with header row)
-        cols = ["ts_iso", "ts_ms"] + body.data_types
-        df = pd.DataFrame(columns=cols)
-    else:
-        # Order columns: timestamps first, then requested fields in the order provided
-        cols = ["ts_iso", "ts_ms"] + body.data_types
-        # Materialize rows sorted by ts
-        rows = [rows_by_ts[k] for k in sorted(rows_by_ts.keys())]
-        df = pd.DataFrame(rows)
-        # Make sure all requested cols exist
-        for c in cols:
-            if c not in df.columns:
-                df[c] = pd.NA
-        df = df[cols]
-
-    # Meta sheet
-    meta = {
-        "device_name": body.device_name,
-        "data_types": ",".join(body.data_types),
-        "include_alarms": body.include_alarms,
-        "start_date": body.start_date.isoformat(),
-        "end_date": body.end_date.isoformat(),
-        "generated_at": datetime.utcnow().isoformat() + "Z",
-        "account_base_url": base,
-        "points_pack_out": len(ts_data.get("pack_out", [])) if "pack_out" in ts_data else 0,
-        "points_pack_calc": len(ts_data.get("pack_calc", [])) if "pack_calc" in ts_data else 0,
-        "points_pack_raw": len(ts_data.get("pack_raw", [])) if "pack_raw" in ts_data else 0,
-    }
-    metadata_df = pd.DataFrame([meta])
-
-    # Save to Excel
-    filename = _make_filename(body.device_name, body.start_date, body.end_date)
-    fpath = os.path.join(REPORT_DIR, filename)
-    with pd.ExcelWriter(fpath, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="data")
-        metadata_df.to_excel(writer, index=False, sheet_name="meta")
-
-    return {
-        "filename": filename,
-        "download_url": f"/download/{filename}",
-    }
-
-@router.get("/download/{filename}")
-def download_report(filename: str):
+def _expand_points(points: pd.Series, src_cols: List[str]) -> pd.DataFrame:
     """
-    Serve a previously generated report from REPORT_DIR.
+    Parse every packed string of one fetched key (a ts-indexed column) in one pass
+    into a frame indexed by ts_ms, keeping only `src_cols`. Non-string values and
+    gaps are skipped.
     """
-    safe = _safe_filename(filename)
-    if safe != filename:
-        raise HTTPException(status_code=400, detail="Invalid filename")
-    fpath = os.path.join(REPORT_DIR, filename)
-    if not os.path.exists(fpath):
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(
-        fpath,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        filename=filename,
-    )
-# report_logic.py
-import os
-import re
-import time
-import json
-import uuid
-import math
-import logging
-from datetime import datetime, date, timedelta
-from typing import List, Optional, Any, Dict, Tuple
-
-import pandas as pd
-import requests
-from fastapi import APIRouter, Header, HTTPException
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, Field, field_validator
-
-# Shared parser for packed strings
-from pack_format import parse_pack_raw
-
-logger = logging.getLogger("report_logic")
-router = APIRouter()
-
-# Where to store generated files on Render (ephemeral but fine for downloads)
-REPORT_DIR = os.getenv("REPORT_DIR", "/tmp")
-os.makedirs(REPORT_DIR, exist_ok=True)
-
-# --- ThingsBoard account routing (multi-tenant) --------------------------------
-def _load_tb_accounts() -> Dict[str, str]:
-    raw = os.getenv("TB_ACCOUNTS", "").strip()
-    if raw:
+    values = points[points.map(lambda v: isinstance(v, str))]
+    # Parse each distinct pack once (an idle lift repeats the same pack for minutes),
+    # then fan the results back out to every point
+    codes, uniq = pd.factorize(values)
+    parsed = None
+    pool = _get_parse_pool() if len(uniq) >= PARSE_POOL_MIN_PACKS else None
+    if pool is not None:
         try:
-            data = json.loads(raw)
-            if isinstance(data, dict) and data:
-                return {str(k): str(v) for k, v in data.items()}
+            parsed = list(pool.map(parse_pack_raw, uniq, chunksize=2048))
         except Exception as e:
-            logger.warning("[TB_ACCOUNTS] parse failed: %s", e)
-    base = os.getenv("TB_BASE_URL", "https://thingsboard.cloud").strip()
-    return {"default": base}
-
-TB_ACCOUNTS = _load_tb_accounts()
-logger.info("[INIT] Loaded ThingsBoard accounts: %s", list(TB_ACCOUNTS.keys()))
-
-def _choose_base_url(x_tb_account: Optional[str]) -> str:
-    if x_tb_account:
-        if x_tb_account in TB_ACCOUNTS:
-            return TB_ACCOUNTS[x_tb_account]
-        if x_tb_account.lower() in TB_ACCOUNTS:
-            return TB_ACCOUNTS[x_tb_account.lower()]
-    return next(iter(TB_ACCOUNTS.values()))
-
-# --- Input types ---------------------------------------------------------------
-ALLOWED_TYPES = {
-    "height",
-    "direction",
-    "lift_status",
-    "current_floor_index",
-    "current_floor_label",
-    "x_vibe",
-    "y_vibe",
-    "z_vibe",
-    "x_jerk",
-    "y_jerk",
-    "z_jerk",
-}
+            logger.warning("[/generate_report] parse pool failed, parsing inline: %s", e)
+            _drop_parse_pool()
+    if parsed is None:
+        parsed = [_parse_pack_cached(v) for v in uniq]
+    # Column-major: one array per column over the distinct packs (dtype inferred
+    # there; absent keys are NaN), fanned out to every point with a vectorized take
+    return pd.DataFrame(
+        {c: pd.Series([d.get(c, math.nan) for d in parsed]).take(codes).to_numpy() for c in src_cols},
+        index=values.index.rename("ts_ms"),
+        columns=src_cols,
+    )
 
-# --- Helpers: date/time parsing ------------------------------------------------
-def _parse_any_date(val: Any) -> date:
+def _expand_calc_frame(points: pd.Series, want: List[str]) -> pd.DataFrame:
     """
-    Accept:
-      - 'YYYY-MM-DD'
-      - ISO datetime strings
-      - epoch millis or seconds (int/str)
-    Return Python date (no time component).
+    Map pack_calc/pack_out points to the wanted calculated columns.
+    Expected short keys: h (height), fi, fl, dir, st.
     """
-    if val is None or val == "":
-        raise ValueError("missing date")
-
-    # int-like → epoch
-    if isinstance(val, (int, float)) or (isinstance(val, str) and val.isdigit()):
-        x = int(val)
-        # assume ms if it's too large
-        if x > 10_000_000_000:
-            dt = datetime.utcfromtimestamp(x / 1000.0)
+    cols = [c for c in want if c in _CALC_FIELDS or c == "lift_status"]
+    parsed = _expand_points(points, [_CALC_FIELDS.get(c, "st") for c in cols])
+    out = pd.DataFrame(index=parsed.index)
+    for c in cols:
+        if c == "lift_status":
+            # M/I -> moving/idle, anything else -> ""
+            out[c] = parsed["st"].astype(str).str.upper().map(_LIFT_STATUS).fillna("")
         else:
-            dt = datetime.utcfromtimestamp(x)
-        return dt.date()
-
-    if isinstance(val, date) and not isinstance(val, datetime):
-        return val
-
-    s = str(val).strip()
+            out[c] = parsed[_CALC_FIELDS[c]]
+    return out
 
-    # YYYY-MM-DD
-    if re.match(r"^\d{4}-\d{2}-\d{2}$", s):
-        return datetime.strptime(s, "%Y-%m-%d").date()
+def _expand_raw_frame(points: pd.Series, want: List[str]) -> pd.DataFrame:
+    """
+    Map pack_raw points to vibe/jerk columns, falling back to accelerometer/gyro values.
+    """
+    cols = [c for c in want if c in _RAW_FALLBACKS]
+    parsed = _expand_points(points, cols + [_RAW_FALLBACKS[c] for c in cols])
+    return pd.DataFrame(
+        {c: parsed[c].combine_first(parsed[_RAW_FALLBACKS[c]]) for c in cols},
+        index=parsed.index,
+    )
 
-    # ISO datetime
-    try:
-        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
-        return dt.date()
-    except Exception:
-        pass
+# --- File helpers -------------------------------------------------------------
+_XLSX_OPTIONS = {
+    "constant_memory": True,
+    "strings_to_numbers": False,
+    "strings_to_formulas": False,
+    "strings_to_urls": False,
+}
 
-    raise ValueError(f"unrecognized date format: {val!r}")
+def _safe_filename(base: str) -> str:
+    s = _UNSAFE_RE.sub("_", base).strip("._-")
+    return s or "report"
 
-# --- Request model -------------------------------------------------------------
-class ReportRequest(BaseModel):
-    device_name: str = Field(..., alias="deviceName")
-    data_types: List[str] = Field(..., alias="dataTypes")
-    include_alarms: bool = Field(True, alias="includeAlarms")
-    start_date: Any = Field(..., alias="startDate")  # date-like
-    end_date: Any = Field(..., alias="endDate")      # date-like
+def _check_filename(filename: str) -> None:
+    """
+    Reject anything _safe_filename could not have produced (single regex walk,
+    no sanitized copy).
+    """
+    if (not _SAFE_FILENAME_RE.fullmatch(filename)
+            or filename.startswith((".", "-", "_"))
+            or ".." in filename):
+        raise HTTPException(status_code=400, detail="Invalid filename")
 
-    model_config = {
-        "populate_by_name": True,
-        "extra": "ignore",
-        "str_min_length": 1,
+def _report_key(base: str, jwt: str, device_id: str, body: "ReportRequest", start_ms: int, end_ms: int) -> str:
+    """
+    Content hash of everything that shapes a report, caller's JWT included: the
+    same caller asking for the same report gets the same file, while names stay
+    unguessable and one user's file is never handed to another.
+    """
+    ident = {
+        "base": base,
+        "jwt": jwt,
+        "device_id": device_id,
+        "device_name": body.device_name,
+        "start_ms": start_ms,
+        "end_ms": end_ms,
+        "data_types": body.data_types,
+        "include_alarms": body.include_alarms,
+        "format": body.report_format,
     }
+    return hashlib.blake2b(orjson.dumps(ident, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
 
-    @field_validator("start_date", "end_date", mode="before")
-    @classmethod
-    def _coerce_dates(cls, v):
-        return _parse_any_date(v)
-
-    @field_validator("data_types", mode="after")
-    @classmethod
-    def _filter_types(cls, v: List[str]):
-        if not v:
-            raise ValueError("data_types cannot be empty")
-        filtered = [t for t in v if t in ALLOWED_TYPES]
-        if not filtered:
-            raise ValueError("No valid data_types provided")
-        # Deduplicate while preserving order
-        seen = set()
-        result = []
-        for t in filtered:
-            if t not in seen:
-                seen.add(t)
-                result.append(t)
-        return result
-
-# --- TB REST helpers -----------------------------------------------------------
-def _tb_headers(jwt: str) -> Dict[str, str]:
-    return {"X-Authorization": f"Bearer {jwt}"}
+def _make_filename(device_name: str, start: date, end: date, ext: str, key: str) -> str:
+    base = _safe_filename(f"{device_name}_{start.isoformat()}_{end.isoformat()}")
+    return f"{base}_{key}.{ext}"
 
-def _tb_get(base: str, path: str, jwt: str, params: Optional[dict] = None):
-    url = f"{base.rstrip('/')}{path}"
-    r = requests.get(url, headers=_tb_headers(jwt), params=params or {}, timeout=30)
-    if r.status_code >= 400:
-        raise HTTPException(status_code=r.status_code, detail=f"TB GET {path} failed: {r.text}")
-    try:
-        return r.json()
-    except Exception:
-        return r.text
+def _media_type(filename: str) -> str:
+    return REPORT_FORMATS.get(filename.rsplit(".", 1)[-1], "application/octet-stream")
 
-def _page_all(fn, *args, page_size=100):
-    results = []
-    page = 0
-    while True:
-        data = fn(page=page, pageSize=page_size, *args)
-        if isinstance(data, dict):
-            chunk = data.get("data") or []
-            if isinstance(chunk, list):
-                results.extend(chunk)
-            has_next = data.get("hasNext", False)
-            if not has_next:
-                break
-            page += 1
-        else:
-            break
-    return results
+_WRITE_BLOCK_ROWS = 8192
 
-def _find_device_id(base: str, jwt: str, device_name: str) -> Optional[str]:
+def _write_frame(ws, df: pd.DataFrame) -> None:
     """
-    Robust device lookup that works for tenant admins and normal users.
-    Tries a few endpoints and falls back to listing visible devices.
+    Write header + rows of `df` to an xlsxwriter worksheet, strictly in row order
+    (required by constant_memory mode). Missing values (NaN/NA) become empty cells.
+    Rows are converted a block at a time so only one block's object copy is alive;
+    each column becomes a plain list and rows are zipped back together, which is
+    cheaper than itertuples over a converted frame.
     """
-    # 1) Tenant admin direct lookup
+    ws.write_row(0, 0, list(df.columns))
+    i = 1
+    for start in range(0, len(df), _WRITE_BLOCK_ROWS):
+        block = df.iloc[start:start + _WRITE_BLOCK_ROWS]
+        cols = [col.astype(object).where(col.notna(), None).tolist() for _, col in block.items()]
+        for row in zip(*cols):
+            ws.write_row(i, 0, row)
+            i += 1
+
+# --- In-memory report cache ---------------------------------------------------
+_report_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_report_cache_bytes = 0
+_report_cache_lock = threading.Lock()
+
+def _cache_put(filename: str, data: bytes) -> None:
+    global _report_cache_bytes
+    if len(data) > REPORT_CACHE_MAX_BYTES:
+        return
+    with _report_cache_lock:
+        old = _report_cache.pop(filename, None)
+        if old is not None:
+            _report_cache_bytes -= len(old)
+        _report_cache[filename] = data
+        _report_cache_bytes += len(data)
+        while _report_cache_bytes > REPORT_CACHE_MAX_BYTES:
+            _, evicted = _report_cache.popitem(last=False)
+            _report_cache_bytes -= len(evicted)
+
+def _cache_get(filename: str) -> Optional[bytes]:
+    with _report_cache_lock:
+        data = _report_cache.get(filename)
+        if data is not None:
+            _report_cache.move_to_end(filename)
+        return data
+
+def _cache_drop(filename: str) -> None:
+    global _report_cache_bytes
+    with _report_cache_lock:
+        old = _report_cache.pop(filename, None)
+        if old is not None:
+            _report_cache_bytes -= len(old)
+
+# --- Background report jobs --------------------------------------------------
+# Fetch + Excel build run on a small worker pool so the request returns as soon as
+# the device is resolved; download/status endpoints report progress by filename.
+# Filenames are content hashes, so identical requests (repeat clicks, even across
+# restarts) reuse a running build or a file younger than REPORT_DEDUP_TTL seconds.
+# At most MAX_PENDING_REPORTS builds may be queued or running at once, and a
+# janitor deletes report files older than REPORT_FILE_TTL.
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+MAX_PENDING_REPORTS = int(os.getenv("MAX_PENDING_REPORTS", "16"))
+REPORT_DEDUP_TTL = float(os.getenv("REPORT_DEDUP_TTL", "900"))
+REPORT_FILE_TTL = float(os.getenv("REPORT_FILE_TTL", str(24 * 3600)))
+_JANITOR_INTERVAL_S = 600
+_MAX_JOB_ERRORS = 256
+
+_report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+_jobs: Dict[str, Future] = {}                        # filename -> pending build
+_job_errors: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()  # filename -> (status, detail)
+_jobs_lock = threading.Lock()
+_janitor_started = False
+
+def _on_job_done(filename: str, fut: Future) -> None:
+    exc = fut.exception()
+    with _jobs_lock:
+        _jobs.pop(filename, None)
+        if exc is not None:
+            if isinstance(exc, HTTPException):
+                _job_errors[filename] = (exc.status_code, str(exc.detail))
+            else:
+                _job_errors[filename] = (500, "Report generation failed")
+            while len(_job_errors) > _MAX_JOB_ERRORS:
+                _job_errors.popitem(last=False)
+    if exc is not None:
+        logger.error("[/generate_report] job %s failed: %s", filename, exc)
+
+def _report_available(filename: str) -> bool:
+    return _cache_get(filename) is not None or os.path.isfile(os.path.join(REPORT_DIR, filename))
+
+def _report_is_fresh(filename: str) -> bool:
     try:
-        data = _tb_get(base, f"/api/tenant/devices?deviceName={device_name}", jwt)
-        if isinstance(data, dict):
-            did = (data.get("id") or {}).get("id")
-            if isinstance(did, str):
-                return did
-    except HTTPException:
-        pass
+        return os.stat(os.path.join(REPORT_DIR, filename)).st_mtime > time.time() - REPORT_DEDUP_TTL
+    except OSError:
+        return False
 
-    # 2) List visible devices to the user and match by name
-    try:
-        me = _tb_get(base, "/api/auth/user", jwt)
-        authority = str(me.get("authority", "")).upper()
-        customer_obj = me.get("customerId") if isinstance(me.get("customerId"), dict) else None
-        customer_id = (customer_obj or {}).get("id") if isinstance(customer_obj, dict) else None
-
-        def normalize_devices(items: List[dict]) -> List[Dict[str, str]]:
-            out = []
-            for d in items:
-                did_obj = d.get("id") if isinstance(d.get("id"), dict) else None
-                did = (did_obj or {}).get("id") if isinstance(did_obj, dict) else None
-                name = d.get("name")
-                if isinstance(did, str) and isinstance(name, str):
-                    out.append({"id": did, "name": name})
-            return out
-
-        if authority == "TENANT_ADMIN":
-            def fetch_page(page=0, pageSize=100, **_):
-                return _tb_get(base, "/api/tenant/devices", jwt, params={"page": page, "pageSize": pageSize})
-            all_devices = _page_all(fetch_page)
-        elif customer_id:
-            def fetch_page(page=0, pageSize=100, **_):
-                return _tb_get(base, f"/api/customer/{customer_id}/devices", jwt, params={"page": page, "pageSize": pageSize})
-            all_devices = _page_all(fetch_page)
-        else:
-            def fetch_page(page=0, pageSize=100, **_):
-                return _tb_get(base, "/api/user/devices", jwt, params={"page": page, "pageSize": pageSize})
-            all_devices = _page_all(fetch_page)
-
-        for d in normalize_devices(all_devices):
-            if d["name"] == device_name:
-                return d["id"]
-    except Exception as e:
-        logger.warning("Device lookup fallback failed: %s", e)
+def _submit_report_job(filename: str, fn, *args, reuse_file: bool = True) -> None:
+    """
+    Start a build for `filename` unless one is already running or (with
+    `reuse_file`) the file was built within REPORT_DEDUP_TTL. A previously failed
+    build is retried.
+    """
+    with _jobs_lock:
+        if filename in _jobs:
+            return
+        if reuse_file and filename not in _job_errors and _report_is_fresh(filename):
+            return
+        if len(_jobs) >= MAX_PENDING_REPORTS:
+            raise HTTPException(status_code=503, detail="Too many reports in progress, retry shortly")
+        _job_errors.pop(filename, None)
+        fut = _report_executor.submit(fn, *args)
+        _jobs[filename] = fut
+    fut.add_done_callback(lambda f: _on_job_done(filename, f))
+
+def _sweep_report_dir() -> None:
+    cutoff = time.time() - REPORT_FILE_TTL
+    with os.scandir(REPORT_DIR) as it:
+        for entry in it:
+            if not _REPORT_FILE_RE.fullmatch(entry.name):
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    _cache_drop(entry.name)
+            except OSError:
+                pass
+
+def _janitor_loop() -> None:
+    while True:
+        time.sleep(_JANITOR_INTERVAL_S)
+        try:
+            _sweep_report_dir()
+        except Exception as e:
+            logger.warning("[report-janitor] sweep failed: %s", e)
 
-    return None
+def _ensure_janitor() -> None:
+    global _janitor_started
+    with _jobs_lock:
+        if _janitor_started:
+            return
+        _janitor_started = True
+    threading.Thread(target=_janitor_loop, name="report-janitor", daemon=True).start()
 
-def _fetch_timeseries_chunks(
+def _job_state(filename: str) -> Tuple[str, Optional[Tuple[int, str]]]:
+    """
+    Return ('pending' | 'failed' | 'unknown', error) for a report filename.
+    'unknown' means no tracked job: the file is either done or never existed.
+    """
+    with _jobs_lock:
+        fut = _jobs.get(filename)
+        if fut is not None and not fut.done():
+            return "pending", None
+        err = _job_errors.get(filename)
+    if err is not None:
+        return "failed", err
+    return "unknown", None
+
+# --- Report build ------------------------------------------------------------
+def _publish_report(tmp_path: str, fpath: str, filename: str) -> None:
+    os.replace(tmp_path, fpath)
+    # Size check before reading: large CSVs can run to hundreds of MB
+    if os.path.getsize(fpath) > REPORT_CACHE_MAX_BYTES:
+        _cache_drop(filename)  # an older copy under this name is now stale
+        return
+    with open(fpath, "rb") as f:
+        _cache_put(filename, f.read())
+
+def _build_report(
+    body: ReportRequest,
     base: str,
     jwt: str,
     device_id: str,
     keys: List[str],
     start_ms: int,
     end_ms: int,
-    *,
-    chunk_ms: int = 6 * 60 * 60 * 1000,   # 6 hours
-    per_call_limit: int = 20000
-) -> Dict[str, List[Dict[str, Any]]]:
+    filename: str,
+) -> None:
     """
-    Fetch timeseries in chunks to avoid TB limits.
-    Returns dict: key -> list of {ts: ms, value: <str|num|bool>}
+    Fetch telemetry, assemble the report frame and write the workbook to REPORT_DIR.
+    Runs on the report worker pool.
     """
-    out: Dict[str, List[Dict[str, Any]]] = {k: [] for k in keys}
-    ks = ",".join(keys)
-    cur = start_ms
-    while cur <= end_ms:
-        window_end = min(end_ms, cur + chunk_ms - 1)
-        params = {
-            "keys": ks,
-            "startTs": cur,
-            "endTs": window_end,
-            "limit": per_call_limit,
-            "agg": "NONE",
-            "useStrictDataTypes": "false",
-        }
-        url = f"/api/plugins/telemetry/DEVICE/{device_id}/values/timeseries"
-        try:
-            data = _tb_get(base, url, jwt, params)
-            if isinstance(data, dict):
-                for k in keys:
-                    if k in data and isinstance(data[k], list):
-                        out[k].extend(data[k])
-        except HTTPException as e:
-            # If TB has no data for a chunk it may 404—tolerate by skipping
-            logger.info("TS fetch chunk %s-%s failed for %s: %s", cur, window_end, ks, e.detail)
-        cur = window_end + 1
-
-    # sort each key by ts ascending & de-dup (keep first seen ts)
-    for k in keys:
-        arr = out[k]
-        arr.sort(key=lambda x: int(x.get("ts", 0)))
-        dedup = []
-        seen_ts = set()
-        for p in arr:
-            ts = int(p.get("ts", 0))
-            if ts in seen_ts:
-                continue
-            seen_ts.add(ts)
-            dedup.append({"ts": ts, "value": p.get("value")})
-        out[k] = dedup
-    return out
-
-# --- Mapping from packed strings to requested columns -------------------------
-def _extract_from_calc_like(pack: str, want: List[str]) -> Dict[str, Any]:
-    """
-    Parse one calc-like row (pack_calc or pack_out) and return dict of wanted fields.
-    Expected short keys: h (height), fi, fl, dir, st.
-    """
-    parsed = parse_pack_raw(pack)
-    out: Dict[str, Any] = {}
-    # height
-    if "height" in want:
-        out["height"] = parsed.get("h")
-    # direction (U/D/S or similar)
-    if "direction" in want:
-        out["direction"] = parsed.get("dir")
-    # lift_status (M/I -> moving/idle)
-    if "lift_status" in want:
-        st = str(parsed.get("st") or "")
-        out["lift_status"] = "moving" if st.upper() == "M" else ("idle" if st.upper() == "I" else "")
-    # floor index/label
-    if "current_floor_index" in want:
-        out["current_floor_index"] = parsed.get("fi")
-    if "current_floor_label" in want:
-        out["current_floor_label"] = parsed.get("fl")
-    return out
-
-def _extract_from_pack_raw(pack: str, want: List[str]) -> Dict[str, Any]:
-    """
-    Parse one pack_raw row and map accelerometer/gyro to vibe/jerk when requested.
-    """
-    parsed = parse_pack_raw(pack)
-    out: Dict[str, Any] = {}
-
-    def pick(mn: str, fallback: str):
-        v = parsed.get(mn)
-        if v is None:
-            v = parsed.get(fallback)
-        return v
-
-    if "x_vibe" in want:
-        out["x_vibe"] = pick("x_vibe", "accel_x_val")
-    if "y_vibe" in want:
-        out["y_vibe"] = pick("y_vibe", "accel_y_val")
-    if "z_vibe" in want:
-        out["z_vibe"] = pick("z_vibe", "accel_z_val")
+    need_calc = "pack_out" in keys
+    need_raw = "pack_raw" in keys
+
+    # A 404 may mean the device was deleted/recreated under the same name: drop the
+    # cached id so the next request resolves it again.
+    def on_not_found():
+        _invalidate_device_id(base, jwt, body.device_name)
+
+    # Pull telemetry in chunks. pack_calc is the legacy key: only fetch it for the
+    # windows where pack_out has nothing, saving a round of TB requests for devices
+    # already on the new rule chain without losing data from before a migration.
+    ts_data = _fetch_timeseries_chunks(
+        base, jwt, device_id, [k for k in keys if k != "pack_calc"], start_ms, end_ms,
+        on_not_found=on_not_found,
+        fallbacks={"pack_out": "pack_calc"} if "pack_calc" in keys else None,
+    )
+    points = {k: int(ts_data[k].notna().sum()) for k in ts_data.columns}
 
-    if "x_jerk" in want:
-        out["x_jerk"] = pick("x_jerk", "gyro_x_val")
-    if "y_jerk" in want:
-        out["y_jerk"] = pick("y_jerk", "gyro_y_val")
-    if "z_jerk" in want:
-        out["z_jerk"] = pick("z_jerk", "gyro_z_val")
+    # Extract each source into a frame indexed by TB timestamp (ms)
+    frames = []
+    if need_calc:
+        # Prefer pack_out (new); pack_calc (legacy) only fills timestamps pack_out lacks
+        calc = pd.concat([
+            _expand_calc_frame(ts_data[k], body.data_types)
+            for k in ("pack_out", "pack_calc") if k in ts_data.columns
+        ])
+        frames.append(calc[~calc.index.duplicated(keep="first")])
+        del calc
+    if need_raw:
+        frames.append(_expand_raw_frame(ts_data["pack_raw"], body.data_types))
+
+    # Align sources on timestamp, then lay out columns: timestamps first, then
+    # requested fields in the order provided. Missing fields become empty cells;
+    # no rows still yields a valid file with a header row.
+    df = frames[0].join(frames[1:], how="outer") if len(frames) > 1 else frames[0]
+    # The only sort: one C-level sort of the merged int64 index
+    df = df.sort_index().reindex(columns=body.data_types)
+    df.insert(0, "ts_ms", df.index)
+    df.insert(0, "ts_iso", _ts_iso_column(df.index))
+    # The raw packed strings are the bulk of the memory; drop them before writing
+    del ts_data, frames
 
-    return out
+    # Meta sheet
+    meta = {
+        "device_name": body.device_name,
+        "data_types": ",".join(body.data_types),
+        "include_alarms": body.include_alarms,
+        "start_date": body.start_date.isoformat(),
+        "end_date": body.end_date.isoformat(),
+        "generated_at": datetime.utcnow().isoformat() + "Z",
+        "account_base_url": base,
+        "points_pack_out": points.get("pack_out", 0),
+        "points_pack_calc": points.get("pack_calc", 0),
+        "points_pack_raw": points.get("pack_raw", 0),
+    }
 
-# --- File helpers -------------------------------------------------------------
-def _safe_filename(base: str) -> str:
-    s = re.sub(r"[^A-Za-z0-9._-]+", "_", base).strip("._-")
-    return s or "report"
+    # Build under a hidden temp name and swap it in atomically: the same filename
+    # may be rebuilt while an older copy is being downloaded
+    fpath = os.path.join(REPORT_DIR, filename)
+    tmp_path = os.path.join(REPORT_DIR, f".{filename}.part")
+    if body.report_format == "csv":
+        # Plain data sheet only; meta is an Excel-only extra
+        df.to_csv(tmp_path, index=False)
+        _publish_report(tmp_path, fpath, filename)
+        return
 
-def _make_filename(device_name: str, start: date, end: date) -> str:
-    base = _safe_filename(f"{device_name}_{start.isoformat()}_{end.isoformat()}")
-    return f"{base}_{uuid.uuid4().hex[:8]}.xlsx"
+    # Save to Excel
+    if len(df) >= _EXCEL_MAX_ROWS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Report has {len(df)} rows, more than Excel allows; request format=csv",
+        )
+    # constant_memory flushes each row to disk as soon as the next one starts,
+    # so memory stays flat regardless of row count. Report cells are plain data:
+    # skip the per-string URL/formula sniffing (and never turn "=..." into a formula).
+    wb = xlsxwriter.Workbook(tmp_path, _XLSX_OPTIONS)
+    try:
+        _write_frame(wb.add_worksheet("data"), df)
+        # Meta is a single header/value pair of rows; no DataFrame needed
+        ws_meta = wb.add_worksheet("meta")
+        ws_meta.write_row(0, 0, list(meta.keys()))
+        ws_meta.write_row(1, 0, [v if isinstance(v, (int, float, bool)) else str(v) for v in meta.values()])
+    finally:
+        wb.close()
+    _publish_report(tmp_path, fpath, filename)
 
 # --- Main endpoint ------------------------------------------------------------
-@router.post("/generate_report/")
+@router.post("/generate_report/", response_model=ReportResponse, status_code=202)
 def generate_report(
     body: ReportRequest,
     authorization: Optional[str] = Header(None, alias="Authorization"),
     x_tb_account: Optional[str] = Header(None, alias="X-TB-Account"),
-):
+) -> ReportResponse:
     """
-    Generate an Excel report for the requested device and fields.
+    Generate an Excel (or CSV, with format=csv) report for the requested device and fields.
     - Pulls telemetry from TB using the caller's JWT.
     - Parses 'pack_calc' and/or 'pack_out' for calculated fields; 'pack_raw' for raw fields.
     - Spreads requested keys into separate columns.
-    - Returns {filename, download_url}.
+    - Answers 202 with {filename, download_url, status_url} immediately; the workbook
+      is built in the background and download_url answers 202 until it is ready.
     """
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid Authorization header")
@@ -867,15 +905,14 @@ def generate_report(
     )
 
     # Resolve device id
-    device_id = _find_device_id(base, jwt, body.device_name)
+    device_id = _resolve_device_id(base, jwt, body.device_name)
     if not device_id:
         raise HTTPException(status_code=404, detail=f"Device '{body.device_name}' not found or not visible to this user")
 
-    # Build time window in ms (full days inclusive, UTC)
-    start_dt = datetime.combine(body.start_date, datetime.min.time())
-    end_dt = datetime.combine(body.end_date, datetime.max.time().replace(microsecond=0))
-    start_ms = int(start_dt.timestamp() * 1000)
-    end_ms = int(end_dt.timestamp() * 1000)
+    # Build time window in ms (full days inclusive, UTC): one datetime conversion,
+    # the end is plain day arithmetic up to the last ms of end_date
+    start_ms = int(datetime.combine(body.start_date, _MIDNIGHT).timestamp() * 1000)
+    end_ms = start_ms + ((body.end_date - body.start_date).days + 1) * _DAY_MS - 1
 
     # Decide which keys to fetch from TB time-series
     need_calc = any(k in body.data_types for k in ("height", "direction", "lift_status", "current_floor_index", "current_floor_label"))
@@ -891,100 +928,68 @@ def generate_report(
     if not keys:
         raise HTTPException(status_code=400, detail="No fetchable keys for the selected data_types")
 
-    # Pull telemetry in chunks
-    ts_data = _fetch_timeseries_chunks(base, jwt, device_id, keys, start_ms, end_ms)
-
-    # Build rows by TB timestamp (ms)
-    rows_by_ts: Dict[int, Dict[str, Any]] = {}
-
-    def ensure_row(ts_ms: int) -> Dict[str, Any]:
-        r = rows_by_ts.get(ts_ms)
-        if r is None:
-            r = {"ts_ms": ts_ms, "ts_iso": datetime.utcfromtimestamp(ts_ms / 1000.0).isoformat() + "Z"}
-            rows_by_ts[ts_ms] = r
-        return r
-
-    # Prefer pack_out (new) but also accept pack_calc (legacy) for calculated fields
-    if need_calc:
-        for key in ("pack_out", "pack_calc"):
-            for p in ts_data.get(key, []):
-                ts_ms = int(p["ts"])
-                val = p.get("value")
-                if not isinstance(val, str):
-                    continue
-                out = _extract_from_calc_like(val, body.data_types)
-                if out:
-                    row = ensure_row(ts_ms)
-                    row.update(out)
-
-    if need_raw:
-        for p in ts_data.get("pack_raw", []):
-            ts_ms = int(p["ts"])
-            val = p.get("value")
-            if not isinstance(val, str):
-                continue
-            out = _extract_from_pack_raw(val, body.data_types)
-            if out:
-                row = ensure_row(ts_ms)
-                row.update(out)
-
-    # Assemble DataFrame
-    if not rows_by_ts:
-        # Produce an empty but valid file (with header row)
-        cols = ["ts_iso", "ts_ms"] + body.data_types
-        df = pd.DataFrame(columns=cols)
-    else:
-        # Order columns: timestamps first, then requested fields in the order provided
-        cols = ["ts_iso", "ts_ms"] + body.data_types
-        # Materialize rows sorted by ts
-        rows = [rows_by_ts[k] for k in sorted(rows_by_ts.keys())]
-        df = pd.DataFrame(rows)
-        # Make sure all requested cols exist
-        for c in cols:
-            if c not in df.columns:
-                df[c] = pd.NA
-        df = df[cols]
-
-    # Meta sheet
-    meta = {
-        "device_name": body.device_name,
-        "data_types": ",".join(body.data_types),
-        "include_alarms": body.include_alarms,
-        "start_date": body.start_date.isoformat(),
-        "end_date": body.end_date.isoformat(),
-        "generated_at": datetime.utcnow().isoformat() + "Z",
-        "account_base_url": base,
-        "points_pack_out": len(ts_data.get("pack_out", [])) if "pack_out" in ts_data else 0,
-        "points_pack_calc": len(ts_data.get("pack_calc", [])) if "pack_calc" in ts_data else 0,
-        "points_pack_raw": len(ts_data.get("pack_raw", [])) if "pack_raw" in ts_data else 0,
-    }
-    metadata_df = pd.DataFrame([meta])
-
-    # Save to Excel
-    filename = _make_filename(body.device_name, body.start_date, body.end_date)
-    fpath = os.path.join(REPORT_DIR, filename)
-    with pd.ExcelWriter(fpath, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="data")
-        metadata_df.to_excel(writer, index=False, sheet_name="meta")
+    # Same caller + same report -> same filename -> same build/file
+    key = _report_key(base, jwt, device_id, body, start_ms, end_ms)
+    filename = _make_filename(body.device_name, body.start_date, body.end_date, body.report_format, key)
+    _ensure_janitor()
+    # A window still open (it includes today) keeps gaining points: share an
+    # in-flight build, but never hand back a file built earlier
+    _submit_report_job(
+        filename, _build_report, body, base, jwt, device_id, keys, start_ms, end_ms, filename,
+        reuse_file=end_ms < time.time() * 1000,
+    )
 
-    return {
-        "filename": filename,
-        "download_url": f"/download/{filename}",
-    }
+    return ReportResponse(
+        filename=filename,
+        download_url=f"/download/{filename}",
+        status_url=f"/report_status/{filename}",
+    )
 
 @router.get("/download/{filename}")
 def download_report(filename: str):
     """
-    Serve a previously generated report from REPORT_DIR.
+    Serve a previously generated report, from the in-memory cache when possible,
+    otherwise from REPORT_DIR.
     """
-    safe = _safe_filename(filename)
-    if safe != filename:
-        raise HTTPException(status_code=400, detail="Invalid filename")
+    _check_filename(filename)
+    state, err = _job_state(filename)
+    if state == "pending":
+        return JSONResponse(status_code=202, content={"filename": filename, "ready": False})
+    if state == "failed":
+        raise HTTPException(status_code=err[0], detail=err[1])
+    data = _cache_get(filename)
+    if data is not None:
+        return Response(
+            content=data,
+            media_type=_media_type(filename),
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
     fpath = os.path.join(REPORT_DIR, filename)
-    if not os.path.exists(fpath):
+    # One stat here, handed to FileResponse so it does not stat the file again
+    try:
+        st = os.stat(fpath)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
     return FileResponse(
         fpath,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        stat_result=st,
+        media_type=_media_type(filename),
         filename=filename,
-    )
\ No newline at end of file
+    )
+
+@router.get("/report_status/{filename}")
+def report_status(filename: str):
+    """
+    Poll a report started by /generate_report/: status goes pending -> done | failed.
+    """
+    _check_filename(filename)
+    state, err = _job_state(filename)
+    if state == "pending":
+        return {"filename": filename, "status": "pending", "ready": False}
+    if state == "failed":
+        return {"filename": filename, "status": "failed", "ready": False, "error": err[1]}
+    if not _report_available(filename):
+        raise HTTPException(status_code=404, detail="File not found")
+    return {"filename": filename, "status": "done", "ready": True}
@@ -1,15 +1,51 @@
 import os
+import time
+import base64
+import threading
+import orjson
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger("thingsboard_auth")
 
+# Shared keep-alive session for TB calls (login and any module that imports it),
+# so repeated requests skip the TCP/TLS handshake.
+TB_SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=Retry(total=2, backoff_factor=0.2))
+TB_SESSION.mount("http://", _adapter)
+TB_SESSION.mount("https://", _adapter)
+
+# Admin JWTs are reused until shortly before their 'exp' claim instead of logging
+# in again on every call. Keyed by (account, base_url).
+_JWT_REFRESH_MARGIN_S = 60
+_JWT_FALLBACK_TTL_S = 15 * 60
+_jwt_cache: dict[tuple[str, str], tuple[str, float]] = {}
+_jwt_lock = threading.Lock()
+
+
+def _jwt_expiry(token: str) -> float:
+    """
+    Epoch seconds from the token's 'exp' claim. The signature is not verified:
+    TB checks the token itself on every call. Unreadable claims get a short TTL.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = orjson.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        if isinstance(exp, (int, float)):
+            return float(exp)
+    except Exception:
+        pass
+    return time.time() + _JWT_FALLBACK_TTL_S
+
 
 def login_to_thingsboard(base_url: str, username: str, password: str):
     url = f"{base_url}/api/auth/login"
     payload = {"username": username, "password": password}
     try:
-        response = requests.post(url, json=payload, timeout=20)
+        response = TB_SESSION.post(url, json=payload, timeout=20)
         response.raise_for_status()
         jwt_token = response.json().get("token")
         if not jwt_token:
@@ -21,16 +57,21 @@ def login_to_thingsboard(base_url: str, username: str, password: str):
         return None
 
 
+def _jwt_key(account_id: str | None, base_url: str | None) -> tuple[str, str]:
+    return (account_id or "ACCOUNT1").upper(), base_url or os.getenv("TB_BASE_URL", "https://thingsboard.cloud")
+
+
 def get_admin_jwt(account_id: str | None = None, base_url: str | None = None) -> str | None:
     """
     Shared function used by multiple files to get JWT token.
+    Tokens are cached per (account, base_url) until ~60s before they expire.
 
     Defaults:
       - account_id: 'ACCOUNT1' (or whatever you export via env)
       - base_url: env TB_BASE_URL or https://thingsboard.cloud
     """
-    account = (account_id or "ACCOUNT1").upper()
-    tb_base = base_url or os.getenv("TB_BASE_URL", "https://thingsboard.cloud")
+    key = _jwt_key(account_id, base_url)
+    account, tb_base = key
 
     user_env = f"{account}_ADMIN_USER"
     pass_env = f"{account}_ADMIN_PASS"
@@ -41,4 +82,23 @@ def get_admin_jwt(account_id: str | None = None, base_url: str | None = None) ->
         logger.warning(f"[Auth] Missing admin credentials in env: {user_env}/{pass_env}")
         return None
 
-    return login_to_thingsboard(tb_base, username, password)
\ No newline at end of file
+    with _jwt_lock:
+        hit = _jwt_cache.get(key)
+    if hit is not None and hit[1] - _JWT_REFRESH_MARGIN_S > time.time():
+        return hit[0]
+
+    token = login_to_thingsboard(tb_base, username, password)
+    if token:
+        with _jwt_lock:
+            _jwt_cache[key] = (token, _jwt_expiry(token))
+    return token
+
+
+def invalidate_admin_jwt(account_id: str | None = None, base_url: str | None = None) -> None:
+    """
+    Forget the cached admin JWT so the next get_admin_jwt() logs in again.
+    Call on a 401: TB may revoke a token well before its 'exp' (password change,
+    logout, restart with a new signing key).
+    """
+    with _jwt_lock:
+        _jwt_cache.pop(_jwt_key(account_id, base_url), None)